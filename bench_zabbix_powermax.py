@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+""" Micro-benchmark for turning Unisphere stats responses into Zabbix
+    metrics
+
+    Builds a synthetic --hours 24 style payload (288 samples per object)
+    and times running it through process_perf_results in both the per
+    metric and JSON master item modes.  Decoding the payload is timed too,
+    but only cassette replays decode it themselves, PyU4V decodes live
+    Unisphere responses with the json module whatever we have installed.
+    Nothing is sent to Zabbix or Unisphere, but PyU4V and pyzabbix need
+    to be importable
+"""
+
+import json
+import time
+import logging
+import argparse
+
+import zabbix_powermax
+
+# 24 hours of 5 minute samples
+samples_per_object = 288
+interval_ms = 300000
+
+
+def build_payload(objects, metrics):
+    """ Build a list of stats responses like get_storage_group_stats
+        returns them, one per object """
+    names = [f"Metric{i}" for i in range(metrics)]
+    end = int(time.time() // 300 * 300 * 1000)
+
+    payload = list()
+    for index in range(objects):
+        result = list()
+        for sample in range(samples_per_object):
+            values = {name: float(index + sample) for name in names}
+            values['timestamp'] = end - sample * interval_ms
+            result.append(values)
+        payload.append({'array_id': '000000000001',
+                        'storage_group_id': f"SG{index}",
+                        'result': result})
+
+    return payload
+
+
+def best_of(repeat, func):
+    """ Returns the fastest of repeat runs of func, in seconds """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_transform(payload, json_master_items):
+    """ Run every response through process_perf_results, returns how many
+        metrics were built """
+    zabbix_powermax.json_master_items = json_master_items
+
+    built = 0
+    for metrics in payload:
+        zabbix_powermax.process_perf_results(metrics, 'StorageGroup')
+        built += len(zabbix_powermax.send_buffer)
+        zabbix_powermax.send_buffer.clear()
+
+    return built
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--objects', action='store', type=int, default=50,
+                        help="Number of objects in the payload")
+
+    parser.add_argument('--metrics', action='store', type=int, default=40,
+                        help="Number of metrics per sample")
+
+    parser.add_argument('--repeat', action='store', type=int, default=3,
+                        help="Runs of each benchmark, the fastest is shown")
+
+    parser.add_argument('--debug', action='store_true',
+                        help="Time with debug logging enabled, as it is with "
+                             "the default log_level")
+
+    args = parser.parse_args()
+
+    # Log to nowhere so only the cost of building the messages is timed
+    logger = logging.getLogger('discovery')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+
+    # Never fill a chunk, the buffer is cleared after each object
+    zabbix_powermax.sender_chunk_size = float('inf')
+
+    payload = build_payload(args.objects, args.metrics)
+    body = json.dumps(payload)
+    values = args.objects * samples_per_object * args.metrics
+
+    print(f"{args.objects} objects, {samples_per_object} samples of "
+          f"{args.metrics} metrics each, {len(body) / 2**20:.1f} MiB")
+    print(f"orjson {'available' if zabbix_powermax.orjson else 'not found'}")
+    print()
+
+    results = [('Per metric items', best_of(
+        args.repeat, lambda: bench_transform(payload, False)))]
+    results.append(('JSON master items', best_of(
+        args.repeat, lambda: bench_transform(payload, True))))
+
+    # Not on the live collection path, PyU4V does its own decoding
+    replay = [('json.loads', best_of(args.repeat, lambda: json.loads(body)))]
+    if zabbix_powermax.orjson:
+        replay.append(('orjson.loads', best_of(
+            args.repeat, lambda: zabbix_powermax.orjson.loads(body))))
+
+    print(f"{'Benchmark':<20}{'Secs':>9}{'Values/sec':>14}")
+    for name, elapsed in results:
+        print(f"{name:<20}{elapsed:>9.3f}{values / elapsed:>14,.0f}")
+
+    print()
+    print("Decoding, cassette replays only (PyU4V decodes live responses)")
+    for name, elapsed in replay:
+        print(f"{name:<20}{elapsed:>9.3f}{values / elapsed:>14,.0f}")
+
+
+if __name__ == '__main__':
+    main()
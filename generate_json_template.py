@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
+
+""" Generate the JSON master item variant of the Zabbix 5 template
+
+    Every perf trapper item prototype in the standard template is turned
+    into a dependent item of a single master trapper item per object, the
+    value is pulled out of the JSON document with a JSONPath step.  Use the
+    generated template with json_master_items = True in zabbix_powermax.py
+"""
+
+import re
+import copy
+import argparse
+import xml.etree.ElementTree as ET
+
+# Must match key_base in zabbix_powermax.py
+key_base = "dellemc.pmax."
+
+template_suffix = " (JSON)"
+
+# dellemc.pmax.perf.<category>.<metric>[<identifier>]
+perf_key = re.compile(r'^' + re.escape(key_base) +
+                      r'perf\.(?P<category>[^.]+)\.(?P<metric>[^\[]+)'
+                      r'\[(?P<identifier>.*)\]$')
+
+
+def add_text(parent, tag, text):
+    """ Append a child element with the given text """
+    element = ET.SubElement(parent, tag)
+    element.text = text
+    return element
+
+
+def indent(element, level=0, space='    '):
+    """ Pretty print the tree in place, ET.indent needs Python 3.9 """
+    padding = '\n' + space * level
+    if len(element):
+        if not element.text or not element.text.strip():
+            element.text = padding + space
+        for child in element:
+            indent(child, level + 1, space)
+        if not child.tail or not child.tail.strip():
+            child.tail = padding
+    if level and (not element.tail or not element.tail.strip()):
+        element.tail = padding
+
+
+def build_master(prototype, category, identifier):
+    """ Build the master trapper item prototype for a category, based on
+        one of the item prototypes it will replace """
+    master = ET.Element('item_prototype')
+    add_text(master, 'name', f"{identifier} Raw Metrics")
+    add_text(master, 'type', 'TRAP')
+    add_text(master, 'key', f"{key_base}perf.{category}.json[{identifier}]")
+    add_text(master, 'delay', '0')
+    add_text(master, 'history', '0')
+    add_text(master, 'trends', '0')
+    add_text(master, 'value_type', 'TEXT')
+
+    applications = prototype.find('applications')
+    if applications is not None:
+        master.append(copy.deepcopy(applications))
+
+    return master
+
+
+def make_dependent(prototype, metric, master_key):
+    """ Convert a trapper item prototype into a dependent one """
+    prototype.find('type').text = 'DEPENDENT'
+
+    # The JSONPath step has to come before any existing preprocessing
+    # (multipliers etc.) so insert it at the front
+    preprocessing = prototype.find('preprocessing')
+    if preprocessing is None:
+        preprocessing = ET.SubElement(prototype, 'preprocessing')
+
+    step = ET.Element('step')
+    add_text(step, 'type', 'JSONPATH')
+    parameters = ET.SubElement(step, 'parameters')
+    add_text(parameters, 'parameter', f"$.{metric}")
+    # Not every KPI is returned for every object, don't go unsupported
+    add_text(step, 'error_handler', 'DISCARD_VALUE')
+    preprocessing.insert(0, step)
+
+    master_item = ET.SubElement(prototype, 'master_item')
+    add_text(master_item, 'key', master_key)
+
+
+def convert_rule(rule):
+    """ Convert the item prototypes of one discovery rule, returns the
+        number of items converted """
+    prototypes = rule.find('item_prototypes')
+    if prototypes is None:
+        return 0
+
+    masters = dict()
+    converted = 0
+    for prototype in list(prototypes):
+        match = perf_key.match(prototype.find('key').text)
+        if not match or prototype.find('type').text != 'TRAP':
+            continue    # health scores and the like stay as they are
+
+        category = match.group('category')
+        identifier = match.group('identifier')
+        master_key = f"{key_base}perf.{category}.json[{identifier}]"
+
+        if master_key not in masters:
+            masters[master_key] = build_master(prototype, category,
+                                               identifier)
+
+        make_dependent(prototype, match.group('metric'), master_key)
+        converted += 1
+
+    # Masters first so they read sensibly in the UI and the export
+    for index, master in enumerate(masters.values()):
+        prototypes.insert(index, master)
+
+    return converted
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--input', '-i', action='store',
+                        default="zabbix_v5_powermax_template.xml",
+                        help="Standard Zabbix 5 template to convert")
+
+    parser.add_argument('--output', '-o', action='store',
+                        default="zabbix_v5_powermax_json_template.xml",
+                        help="Path to write the JSON variant template to")
+
+    args = parser.parse_args()
+
+    tree = ET.parse(args.input)
+    root = tree.getroot()
+
+    # Rename the template so it can be imported alongside the original,
+    # graphs refer to their items by template name so update those too
+    names = dict()
+    for template in root.find('templates'):
+        for tag in ('template', 'name'):
+            element = template.find(tag)
+            names[element.text] = element.text + template_suffix
+            element.text = names[element.text]
+
+    for host in root.iter('host'):
+        host.text = names.get(host.text, host.text)
+
+    converted = 0
+    for rule in root.iter('discovery_rule'):
+        converted += convert_rule(rule)
+
+    indent(root)
+    with open(args.output, 'w', encoding='UTF-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(ET.tostring(root, encoding='unicode'))
+        f.write('\n')
+
+    print(f"Converted {converted} items, written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
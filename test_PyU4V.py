@@ -1,5 +1,230 @@
 import PyU4V
+import time
 import datetime
+import concurrent.futures
+
+# Number of arrays probed at the same time
+probe_workers = 4
+
+# Number of objects per category we time the stats call for, the average
+# is used to estimate how long a full collection run will take
+probe_samples = 3
+
+# How often statistics collection is scheduled, in seconds
+collection_interval = 300
+
+# Categories collected by zabbix_powermax.py with the keys and stats
+# functions used and how the stats arguments map to the keys response
+probe_categories = {
+    'Array': ('get_array_keys', 'get_array_stats', {}),
+    'FEDirector': ('get_frontend_director_keys',
+                   'get_frontend_director_stats',
+                   {'director_id': 'directorId'}),
+    'FEPort': ('get_frontend_port_keys', 'get_frontend_port_stats',
+               {'director_id': 'directorId', 'port_id': 'portId'}),
+    'BEDirector': ('get_backend_director_keys', 'get_backend_director_stats',
+                   {'director_id': 'directorId'}),
+    'BEPort': ('get_backend_port_keys', 'get_backend_port_stats',
+               {'director_id': 'directorId', 'port_id': 'portId'}),
+    'RDFDirector': ('get_rdf_director_keys', 'get_rdf_director_stats',
+                    {'director_id': 'directorId'}),
+    'RDFPort': ('get_rdf_port_keys', 'get_rdf_port_stats',
+                {'director_id': 'directorId', 'port_id': 'portId'}),
+    'EDSDirector': ('get_eds_director_keys', 'get_eds_director_stats',
+                    {'director_id': 'directorId'}),
+    'IMDirector': ('get_im_director_keys', 'get_im_director_stats',
+                   {'director_id': 'directorId'}),
+    'SRP': ('get_storage_resource_pool_keys',
+            'get_storage_resource_pool_stats', {'srp_id': 'srpId'}),
+    'StorageGroup': ('get_storage_group_keys', 'get_storage_group_stats',
+                     {'storage_group_id': 'storageGroupId'}),
+    'PortGroup': ('get_port_group_keys', 'get_port_group_stats',
+                  {'port_group_id': 'portGroupId'}),
+    'Board': ('get_board_keys', 'get_board_stats', {'board_id': 'boardId'}),
+    'DiskGroup': ('get_disk_group_keys', 'get_disk_group_stats',
+                  {'disk_group_id': 'diskGroupId'}),
+    'Host': ('get_host_keys', 'get_host_stats', {'host_id': 'hostId'}),
+    'Initiator': ('get_initiator_perf_keys', 'get_initiator_stats',
+                  {'initiator_id': 'initiatorId'}),
+    'RDFS': ('get_rdfs_keys', 'get_rdfs_stats',
+             {'rdfs_group_id': 'rsGroupId'}),
+    'RDFA': ('get_rdfa_keys', 'get_rdfa_stats',
+             {'rdfa_group_id': 'raGroupId'}),
+    'ISCSITarget': ('get_iscsi_target_keys', 'get_iscsi_target_stats',
+                    {'iscsi_target_id': 'iscsiTargetId'})}
+
+
+def timed(func, **kwargs):
+    """ Call func, returning the result and how long it took in seconds """
+    start = time.time()
+    result = func(**kwargs)
+    return result, time.time() - start
+
+
+def list_keys(conn, array_id, category):
+    """ List the objects in a category, returns the objects and the time
+        taken.  Ports are listed per director so the times are summed """
+    keys_func = getattr(conn.performance, probe_categories[category][0])
+
+    if category == 'Array':
+        items, elapsed = timed(keys_func)
+        return [i for i in items if i.get('symmetrixId') == array_id], elapsed
+
+    if not category.endswith('Port'):
+        return timed(keys_func, array_id=array_id)
+
+    directors, elapsed = list_keys(conn, array_id,
+                                   category.replace('Port', 'Director'))
+    items = list()
+    for director in directors:
+        try:
+            ports, port_time = timed(keys_func, array_id=array_id,
+                                     director_id=director['directorId'])
+        except PyU4V.utils.exception.ResourceNotFoundException:
+            continue
+        elapsed += port_time
+        for port in ports:
+            items.append(dict(port, directorId=director['directorId']))
+
+    return items, elapsed
+
+
+def probe_category(conn, array_id, category):
+    """ Time the key listing and a sample of stats calls for a category """
+    result = {'category': category, 'objects': 0, 'keys_time': 0.0,
+              'stats_time': 0.0, 'samples': 0, 'failed': 0}
+
+    try:
+        items, result['keys_time'] = list_keys(conn, array_id, category)
+    except PyU4V.utils.exception.ResourceNotFoundException:
+        return result
+
+    result['objects'] = len(items)
+    stats_func = getattr(conn.performance, probe_categories[category][1])
+
+    for item in items[:probe_samples]:
+        params = {'metrics': 'KPI'}
+        if category != 'Array':
+            params['array_id'] = array_id
+        for param, key in probe_categories[category][2].items():
+            params[param] = item[key]
+
+        start = time.time()
+        try:
+            stats_func(**params)
+        except (PyU4V.utils.exception.VolumeBackendAPIException,
+                PyU4V.utils.exception.ResourceNotFoundException):
+            result['failed'] += 1
+        result['stats_time'] += time.time() - start
+        result['samples'] += 1
+
+    # Every object needs a stats call, estimate from the sampled average
+    average = result['stats_time'] / result['samples'] if items else 0
+    result['average'] = average
+    result['estimate'] = result['keys_time'] + average * len(items)
+
+    return result
+
+
+def probe_array(array_id):
+    """ Check an array is ready for collection and time each category,
+        one array failing is reported rather than losing every report """
+    report = {'array_id': array_id, 'fall_back': False, 'recent': None,
+              'registered': False, 'categories': list(), 'error': None}
+
+    try:
+        check_array(array_id, report)
+    except Exception as error:
+        report['error'] = f"{type(error).__name__}: {error}"
+
+    return report
+
+
+def check_array(array_id, report):
+    """ Fill in the report for an array, every array gets its own
+        connection as they run in parallel """
+    conn = PyU4V.U4VConn(array_id=array_id)
+
+    try:
+        report['registered'] = (
+            conn.performance.is_array_diagnostic_performance_registered(
+                array_id=array_id))
+    except AttributeError:  # Handle if we're using an older module version
+        report['fall_back'] = True
+        report['registered'] = (
+            conn.performance.is_array_performance_registered(
+                array_id=array_id))
+
+    try:
+        report['recent'] = conn.performance.get_last_available_timestamp(
+            array_id=array_id)
+        report['current'] = conn.performance.is_timestamp_current(
+            report['recent'], minutes=10)
+    except PyU4V.utils.exception.ResourceNotFoundException:
+        return    # Possibly a remote array, nothing to probe
+
+    for category in probe_categories:
+        report['categories'].append(probe_category(conn, array_id, category))
+
+
+def print_report(report, version):
+    """ Print the readiness and latency report for one array """
+    print(f"Array {report['array_id']}")
+    print("---------------------------------------------------")
+
+    if report['fall_back'] and "92" in version[1]:
+        print("WARNING - Module version and Unisphere Version Mismatch")
+
+    if report['error']:
+        print(f"FAILED - {report['error']}\n")
+        return
+
+    print("Diagnostic data collection - ", end='')
+    if not report['registered']:
+        if report['fall_back']:
+            print("FAILED - Manually confirm diagnostics (version mismatch)")
+        else:
+            print("FAILED - Check if diagnostics are enabled")
+    else:
+        print("OK")
+
+    print("Most recent data point - ", end='')
+    if report['recent'] is None:
+        print("Data not found, possibly remote array\n")
+        return
+
+    (s, ms) = divmod(report['recent'], 1000)
+    stamp = datetime.datetime.fromtimestamp(s)
+    if report['current']:
+        print(f"{stamp} - Recency acceptable")
+    else:
+        print(f"{stamp} - Recency not within 10 minutes, "
+              "please run again in 5 minutes.")
+
+    print()
+    print(f"{'Category':<14}{'Objects':>9}{'Keys ms':>10}{'Stats ms':>10}"
+          f"{'Failed':>8}{'Est. secs':>11}")
+
+    total = 0.0
+    calls = 0
+    for c in report['categories']:
+        if not c['objects']:
+            continue
+        total += c['estimate']
+        calls += c['objects']
+        print(f"{c['category']:<14}{c['objects']:>9}"
+              f"{c['keys_time'] * 1000:>10.0f}{c['average'] * 1000:>10.0f}"
+              f"{c['failed']:>8}{c['estimate']:>11.1f}")
+
+    print()
+    throughput = calls / total if total else 0
+    print(f"Estimated full run: {total:.0f} seconds for {calls} stats calls "
+          f"({throughput:.1f} calls/sec)")
+    if total > collection_interval:
+        print(f"WARNING - Longer than the {collection_interval} second "
+              "interval, lengthen the interval or reduce collected objects")
+    print()
+
 
 conn = PyU4V.U4VConn()
 
@@ -15,51 +240,15 @@ for i in array_list:
     print(f"- {i}")
 print()
 
-print("Confirming diagnostic data collection is enabled")
+print(f"Probing {len(array_list)} arrays, {probe_workers} at a time")
 print("---------------------------------------------------")
-test_data = []
-fall_back = False
-for i in array_list:
-    try:
-        pe = conn.performance.is_array_diagnostic_performance_registered()
-    except AttributeError:  # Handle if we're using an older module version
-        fall_back = True
-        if "92" in version[1]:
-            print("WARNING - Module version and Unisphere Version Mismatch")
-        pe = conn.performance.is_array_performance_registered()
-
-    print(f"Checking {i} - ", end='')
-    if not pe:
-        if fall_back:
-            print("FAILED - Manually confirm diagnostics (version mismatch)")
-        else:
-            print("FAILED - Check if diagnostics are enabled")
-    else:
-        print("OK")
-
-    test_data.append(i)
 print()
+start = time.time()
+with concurrent.futures.ThreadPoolExecutor(probe_workers) as executor:
+    reports = executor.map(probe_array, array_list)
 
-print("Confirming Most Recent Data Point")
-print("---------------------------------------------------")
-for i in test_data:
-    print(f"Checking {i} - ", end='')
-
-    try:
-        recent_ts = conn.performance.get_last_available_timestamp(array_id=i)
-    except PyU4V.utils.exception.ResourceNotFoundException:
-        print("Data not found, possibly remote array")
-        continue
-    recent = conn.performance.is_timestamp_current(recent_ts, minutes=10)
-    (s, ms) = divmod(recent_ts, 1000)
-    stamp = datetime.datetime.fromtimestamp(s)
-    if recent:
-        recency = "Recency acceptable"
-    else:
-        recency = ("Recency not within 10 minutes, "
-                   "please run again in 5 minutes.")
+    # Reports come back in array order, printed as soon as they're ready
+    for report in reports:
+        print_report(report, version)
 
-    print(f"{stamp} - {recency}")
-
-print()
-print("Testing Completed")
+print(f"Testing Completed in {time.time() - start:.1f} seconds")
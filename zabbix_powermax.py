@@ -1,8 +1,20 @@
 #!/usr/bin/python3
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
 
+import os
+import re
 import sys
 import json
+import time
+import glob
+import fcntl
+import types
+import hashlib
+import itertools
+import threading
+import collections
+import http.server
+import socketserver
 import PyU4V
 import argparse
 import traceback
@@ -10,6 +22,13 @@ import logging
 import logging.handlers
 from pyzabbix import ZabbixMetric, ZabbixSender
 
+# orjson is optional, if it's installed it's used for the JSON we handle
+# ourselves (state, cassettes, master items and discovery output)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Update to include your Zabbix Server IP and Port
 zabbix_ip = "192.168.1.64"
 zabbix_port = 10051
@@ -27,11 +46,122 @@ host_base = "PowerMax {arrayid}"
 # the default but you will need to update the template appropriately
 key_base = "dellemc.pmax."
 
+# Send all of an object's metrics for a timestamp as a single JSON document
+# to one master trapper item, rather than one trapper value per metric.
+# Zabbix splits it back out with dependent items, this needs the JSON
+# variant of the template (see generate_json_template.py)
+json_master_items = False
+
+# Metrics are queued and sent to Zabbix in chunks of this size, rather than
+# a connection per object and timestamp
+sender_chunk_size = 250
+
+# Address the --serve HTTP endpoint listens on, keep it local unless you
+# intend to share the cached samples with other hosts
+serve_address = "127.0.0.1"
+
+# Samples not refreshed within this many collection intervals of the
+# newest sample are dropped from the --serve cache, so objects removed
+# from the array don't linger forever
+cache_expiry = 3
+
 # Metric recency is used to determine how "fresh" our stats must be
 #  5 is the default (5 minutes), use 0 for testing.  Note this does
 # not change how often diagnostic data is collected ON the array
 metric_recency = 0
 
+# Collection interval in minutes, this should match how often the stats
+# collection is scheduled (cron or Zabbix item).  Used to detect runs
+# that were missed so the gap can be backfilled automatically
+collection_interval = 5
+
+# Unisphere keeps 24 hours of diagnostic data online, we can't backfill
+# anything older than this
+retention_hours = 24
+
+# If Unisphere hasn't published a new diagnostic interval since the last
+# run, wait up to interval_wait seconds for it (checking every interval_poll
+# seconds) before skipping the sweep, saves a full round of wasted calls
+# when cron and the array clock drift apart
+interval_wait = 90
+interval_poll = 15
+
+# State file used to remember the last timestamp collected per category
+# must be writable by the zabbix user, {arrayid} is replaced by the serial
+state_file = "./zabbix_powermax_{arrayid}.state"
+
+# Lock file used to stop a second stats run starting against the same array
+# while one is still going, {arrayid} is replaced by the serial
+lock_file = "./zabbix_powermax_{arrayid}.lock"
+
+# Run budget in seconds, a stats run stops starting new objects once this
+# is used up and carries whatever is left over to the next run.  Keep it a
+# bit under the collection interval so runs never overlap
+run_budget = collection_interval * 60 - 30
+
+# Order categories are collected in during a stats run, most important
+# first so the long tail is what gets carried over if we run out of time
+collection_priority = ['Array', 'FEDirector', 'BEDirector', 'SRP',
+                       'StorageGroup', 'RDFDirector', 'RDFS', 'RDFA',
+                       'PortGroup', 'Board', 'DiskGroup', 'EDSDirector',
+                       'IMDirector', 'ISCSITarget', 'Host', 'Initiator']
+
+# Emulations are rarely needed, add them to the list above to collect them
+# 'RDFEmulation', 'BeEmulation', 'FeEmulation', 'EDSEmulation', 'IMEmulation'
+
+# Limit how many objects of a category become Zabbix items.  Only the top
+# objects by the chosen KPI are discovered and collected every run, the
+# rest are sent as a single "other" object.  Each run also collects the
+# next rotate objects outside the top to keep their ranking fresh, so the
+# top set follows the workload.  Only non-director categories are supported
+# and the KPI must be one the category returns (see the template)
+# e.g. {'Initiator': {'top': 100, 'kpi': 'HostIOs', 'rotate': 50}}
+cardinality_limits = {}
+
+# An object outside the top only replaces the weakest top object once its
+# KPI is this fraction higher, so objects near the cutoff don't flap
+# between their own items and "other"
+promotion_margin = 0.2
+
+# Objects new to the top stay in "other" for this many minutes, long enough
+# for discovery to have created their items (match the LLD interval)
+promotion_delay = 30
+
+# "other" only includes objects sampled within this many collection
+# intervals, older rankings are too stale to add to the current load
+other_max_age = 12
+
+# Metrics containing these are averaged when building the "other" object,
+# everything else is summed
+average_metrics = ['ResponseTime', 'Percent', 'Avg', 'Size']
+
+# When a collection is split with --shard these categories are spread over
+# the shards object by object, every other category is collected in full
+# by one shard.  Array health and KPIs are always on the first shard
+sharded_categories = ['StorageGroup', 'Host', 'Initiator',
+                      'FEPort', 'BEPort', 'RDFPort']
+
+# Set by main when recording to or replaying from a cassette file
+cassette = None
+
+# Metrics waiting to go to Zabbix, see send_to_zabbix
+send_buffer = list()
+
+# Number of chunks Zabbix refused, callers reset it to find out whether
+# what they queued actually arrived
+send_failures = 0
+
+# Set by main when --shard is used, shard_index counts from 0
+shard_index = 0
+shard_count = 1
+
+# Latest sample per object, only kept when running with --serve.  Keyed on
+# (category, identifier) as built by process_perf_results, cache_version
+# changes on every update and is used as the HTTP ETag
+sample_cache = None
+cache_version = 0
+cache_lock = threading.Lock()
+
 
 def log_exception_handler(type, value, tb):
     """ Handle all tracebacks and exceptions going to the logfile """
@@ -67,22 +197,244 @@ def setup_logging(log_file):
     return
 
 
+class Cassette(object):
+    """ Records every Unisphere call we make to a JSON lines file, with the
+        array serials anonymized, or replays them back for offline testing """
+
+    # Connection attributes calls are recorded on
+    groups = ['performance', 'common', 'system']
+
+    # Arguments that change from run to run, if there's no exact match for
+    # a call when replaying we match on everything except these
+    time_args = ['start_time', 'end_time', 'recency']
+
+    # PowerMax serials are 12 digits, for example 000197900255
+    serial_pattern = re.compile(r'(?<!\d)\d{12}(?!\d)')
+
+    def __init__(self, path, replaying=False, speed=1.0):
+        self.path = path
+        self.replaying = replaying
+        self.speed = speed
+        self.serials = dict()
+        self.exact = collections.defaultdict(collections.deque)
+        self.loose = collections.defaultdict(collections.deque)
+
+        if replaying:
+            self.load()
+        else:
+            self.file = open(path, 'w')
+
+    def add_serial(self, serial):
+        """ Returns the anonymized version of a serial """
+        if serial not in self.serials:
+            self.serials[serial] = f"{len(self.serials) + 1:012d}"
+        return self.serials[serial]
+
+    def anonymize(self, data):
+        """ Replace every serial found in the data with its anonymized one """
+        if isinstance(data, str):
+            return self.serial_pattern.sub(
+                lambda m: self.add_serial(m.group(0)), data)
+        if isinstance(data, (list, tuple)):
+            return [self.anonymize(i) for i in data]
+        if isinstance(data, dict):
+            return {self.anonymize(k): self.anonymize(v)
+                    for k, v in data.items()}
+        return data
+
+    def call_keys(self, group, method, args, kwargs):
+        """ Returns the exact and loose lookup keys for a call """
+        loose_kwargs = {k: v for k, v in kwargs.items()
+                        if k not in self.time_args}
+        exact = json.dumps([group, method, args, kwargs], sort_keys=True)
+        loose = json.dumps([group, method, args, loose_kwargs],
+                           sort_keys=True)
+        return exact, loose
+
+    def load(self):
+        """ Load a cassette for replay """
+        logger = logging.getLogger('discovery')
+
+        count = 0
+        with open(self.path) as f:
+            for line in f:
+                entry = json_loads(line)
+                exact, loose = self.call_keys(entry['group'], entry['method'],
+                                              entry['args'], entry['kwargs'])
+                self.exact[exact].append(entry)
+                self.loose[loose].append(entry)
+                count += 1
+
+        logger.info(f"Loaded {count} recorded calls from {self.path}")
+
+    def record(self, group, method, func):
+        """ Wrap a connection method so its calls are recorded """
+        def wrapper(*args, **kwargs):
+            entry = {'group': group, 'method': method,
+                     'args': self.anonymize(args),
+                     'kwargs': self.anonymize(kwargs)}
+
+            start = time.time()
+            try:
+                response = func(*args, **kwargs)
+            except Exception as error:
+                # Connection errors and the like are replayed as a
+                # PyU4VException, anything unknown to PyU4V is
+                entry['error'] = {'type': type(error).__name__,
+                                  'message': self.anonymize(str(error))}
+                raise
+            else:
+                entry['response'] = self.anonymize(response)
+                return response
+            finally:
+                entry['latency'] = time.time() - start
+                self.file.write(json_dumps(entry) + "\n")
+                self.file.flush()
+
+        return wrapper
+
+    def replay(self, group, method):
+        """ Returns a function serving recorded responses for a method """
+        def wrapper(*args, **kwargs):
+            exact, loose = self.call_keys(group, method, list(args), kwargs)
+            entries = self.exact.get(exact) or self.loose.get(loose)
+            if not entries:
+                raise PyU4V.utils.exception.ResourceNotFoundException(
+                    f"No recorded response for {method} {kwargs}")
+
+            # Repeated calls cycle through everything recorded for them
+            entry = entries[0]
+            entries.rotate(-1)
+
+            if self.speed:
+                time.sleep(entry['latency'] / self.speed)
+
+            if 'error' in entry:
+                error = getattr(PyU4V.utils.exception, entry['error']['type'],
+                                PyU4V.utils.exception.PyU4VException)
+                raise error(entry['error']['message'])
+
+            return entry['response']
+
+        return wrapper
+
+    def connect(self, conn=None):
+        """ Returns a connection like object that records calls to conn, or
+            replays them if we're replaying """
+        groups = {name: CassetteGroup(self, name, getattr(conn, name, None))
+                  for name in self.groups}
+        return types.SimpleNamespace(**groups)
+
+
+class CassetteGroup(object):
+    """ Stands in for one attribute of the connection (performance etc.) """
+
+    def __init__(self, cassette, name, target=None):
+        self.cassette = cassette
+        self.name = name
+        self.target = target
+
+    def __getattr__(self, method):
+        if self.cassette.replaying:
+            return self.cassette.replay(self.name, method)
+        return self.cassette.record(self.name, method,
+                                    getattr(self.target, method))
+
+
+def get_connection(configpath):
+    """ Connect to Unisphere, via the cassette if recording or replaying """
+    if cassette and cassette.replaying:
+        return cassette.connect()
+
+    PyU4V.univmax_conn.file_path = configpath
+    conn = PyU4V.U4VConn()
+
+    if cassette:
+        return cassette.connect(conn)
+    return conn
+
+
+def send_to_zabbix(metrics):
+    """ Queue ZabbixMetrics from any iterable, they're sent as soon as we
+        have a full chunk.  Call flush_zabbix to send whatever is left """
+    for metric in metrics:
+        send_buffer.append(metric)
+        if len(send_buffer) >= sender_chunk_size:
+            flush_zabbix()
+
+
+def flush_zabbix():
+    """ Send everything queued to Zabbix, nothing is sent when replaying
+
+        If Zabbix can't be reached the chunk is logged, counted in
+        send_failures and dropped, so an outage doesn't stop the rest of the
+        collection or grow the buffer without limit """
+    global send_failures
+    logger = logging.getLogger('discovery')
+
+    if not send_buffer:
+        return
+
+    try:
+        if cassette and cassette.replaying:
+            res = f"Replaying, {len(send_buffer)} metrics not sent"
+        else:
+            res = ZabbixSender(zabbix_server=zabbix_ip,
+                               zabbix_port=zabbix_port,
+                               chunk_size=sender_chunk_size).send(send_buffer)
+        logger.info(res)
+    except Exception:
+        logger.exception(f"Failed sending {len(send_buffer)} metrics to "
+                         f"Zabbix, dropping them")
+        send_failures += 1
+    finally:
+        send_buffer.clear()
+
+
 def generate_metric_key(base, category, metric, identifier):
     """ Generate a Zabbix formatted key """
     metric_key = f'{base}perf.{category}.{metric}[{identifier}]'
     return metric_key
 
 
-def zabbix_safe_output(data):
-    """ Generate JSON output for zabbix from a passed in list of dicts
+def generate_master_key(base, category, identifier):
+    """ Generate the Zabbix key of the JSON master item for an object """
+    master_key = f'{base}perf.{category}.json[{identifier}]'
+    return master_key
+
+
+def zabbix_safe_output(data, out=sys.stdout):
+    """ Write JSON output for zabbix from any iterable of dicts, each entry
+        is written as it arrives so the whole list is never held in memory
         This is Zabbix 4.x and higher compatible """
 
     logger = logging.getLogger('discovery')
     logger.info("Generating output")
-    output = json.dumps({"data": data}, indent=4, separators=(',', ': '))
-    logger.debug(json.dumps({"data": data}))
 
-    return output
+    count = 0
+    out.write('{\n    "data": [')
+    for entry in data:
+        out.write(',' if count else '')
+        out.write('\n        ' + json_dumps(entry))
+        count += 1
+    out.write('\n    ]\n}\n')
+    out.flush()
+
+    logger.info(f"Output {count} entries")
+
+
+def json_loads(data):
+    """ Decode JSON, with orjson if it's available """
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(data):
+    """ Encode JSON as a str, with orjson if it's available """
+    if orjson:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
 
 
 def fix_ts(timestamp):
@@ -93,13 +445,229 @@ def fix_ts(timestamp):
     return s
 
 
+def shard_owner(key, count):
+    """ Rendezvous hash a key to one of count shards, changing the number
+        of shards only moves the keys that have to move """
+    scores = [hashlib.md5(f"{shard}:{key}".encode()).digest()
+              for shard in range(count)]
+    return scores.index(max(scores))
+
+
+def shard_owns(category, identifier):
+    """ Whether this shard collects the given object """
+    if shard_count == 1:
+        return True
+
+    if category in ('Array', 'Health'):
+        return shard_index == 0
+
+    if category in sharded_categories:
+        return shard_owner(f"{category}:{identifier}", shard_count) \
+            == shard_index
+
+    return shard_owner(category, shard_count) == shard_index
+
+
+def shard_has_work(category):
+    """ Whether this shard collects anything at all for a category, for
+        directors that includes their ports """
+    if category in sharded_categories:
+        return True
+
+    # EDS and IM directors don't have ports
+    port_cat = category.replace('Director', 'Port')
+    if port_cat not in ('FEPort', 'BEPort', 'RDFPort'):
+        return shard_owns(category, None)
+
+    if port_cat in sharded_categories:
+        return True
+    return shard_owns(category, None) or shard_owns(port_cat, None)
+
+
+def shard_suffix(index=None, count=None):
+    """ Suffix for per shard files so shards don't share state or locks,
+        for this shard unless another index and count are given """
+    if index is None:
+        index, count = shard_index, shard_count
+    if count == 1:
+        return ""
+    return f".{index + 1}of{count}"
+
+
+def load_state(arrayid):
+    """ Load the saved collection state for an array, empty if none yet """
+    logger = logging.getLogger('discovery')
+    path = state_file.format(arrayid=arrayid) + shard_suffix()
+
+    state = dict()
+    if cassette and cassette.replaying:
+        logger.info("Replaying, starting with a fresh state")
+    else:
+        try:
+            with open(path) as f:
+                state = json_loads(f.read())
+        except IOError:
+            logger.info(f"No state file found at {path}, starting fresh")
+        except ValueError:
+            logger.warning(f"State file {path} is corrupt, starting fresh")
+
+    # Last timestamp (ms) successfully collected for each category
+    state.setdefault('categories', dict())
+    # Windows of data that still need to be backfilled
+    state.setdefault('backfill', list())
+
+    return state
+
+
+def save_state(arrayid, state):
+    """ Write the collection state, via a temp file so it's never partial """
+    if cassette and cassette.replaying:
+        return
+
+    path = state_file.format(arrayid=arrayid) + shard_suffix()
+    tmp_path = f"{path}.tmp"
+
+    # Lets discovery and the other shards find the current layout
+    state['shard_count'] = shard_count
+
+    with open(tmp_path, 'w') as f:
+        f.write(json_dumps(state))
+    os.replace(tmp_path, path)
+
+
+def read_state(path):
+    """ Read another process's state file, None if it can't be read """
+    logger = logging.getLogger('discovery')
+
+    try:
+        with open(path) as f:
+            return json_loads(f.read())
+    except IOError:
+        return None
+    except ValueError:
+        logger.warning(f"State file {path} is corrupt, ignoring it")
+        return None
+
+
+def current_layout(arrayid):
+    """ Returns the shard count of the most recently saved state file, so
+        files left behind by an earlier --shard layout are ignored """
+    path = state_file.format(arrayid=arrayid)
+    paths = [p for p in glob.glob(glob.escape(path) + '*')
+             if not p.endswith('.tmp')]
+    if not paths:
+        return 1
+
+    state = read_state(max(paths, key=os.path.getmtime)) or dict()
+    return state.get('shard_count', 1)
+
+
+def shard_rankings(arrayid, category, count, skip=None):
+    """ Yields the saved ranking of a category from each shard of a layout
+        of count shards, other than shard index skip """
+    path = state_file.format(arrayid=arrayid)
+
+    for index in range(count):
+        if index == skip:
+            continue
+        state = read_state(path + shard_suffix(index, count)) or dict()
+        ranking = state.get('ranking', dict()).get(category)
+        if ranking:
+            yield ranking
+
+
+def load_rankings(arrayid, category):
+    """ Returns the top identifiers of a limited category, across the
+        state files of every shard as each ranks its own objects """
+    top = set()
+    for ranking in shard_rankings(arrayid, category,
+                                  current_layout(arrayid)):
+        top.update(ranking.get('top', dict()))
+
+    return top
+
+
+def detect_gaps(state, recent_time):
+    """ Queue a backfill window for each category that has missed runs,
+        recent_time is the last available timestamp on the array in ms """
+    logger = logging.getLogger('discovery')
+
+    interval = collection_interval * 60 * 1000
+    oldest = recent_time - retention_hours * 60 * 60 * 1000
+
+    # Drop anything that has aged out of Unisphere in the meantime
+    state['backfill'] = [b for b in state['backfill'] if b['end'] > oldest]
+
+    for category, last in state['categories'].items():
+        if recent_time - last <= interval:
+            continue
+
+        # Don't overlap with anything already queued for this category
+        queued = [b['end'] for b in state['backfill']
+                  if b['category'] == category]
+        start = max([last, oldest] + queued)
+        if recent_time - start <= interval:
+            continue
+
+        # The current run picks up recent_time itself, so stop just short
+        logger.info(f"Gap detected for {category}, last collected {last} "
+                    f"most recent {recent_time}, queueing backfill")
+        state['backfill'].append({'category': category,
+                                  'start': start,
+                                  'end': recent_time - 1,
+                                  'items': None})
+
+
+def acquire_lock(arrayid):
+    """ Take the per array lock, returns the open lock file which must be
+        kept open for the lock to be held, or None if another run has it """
+    logger = logging.getLogger('discovery')
+    path = lock_file.format(arrayid=arrayid) + shard_suffix()
+
+    lock = open(path, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.warning(f"Another collection is running for {arrayid}")
+        lock.close()
+        return None
+
+    return lock
+
+
+def get_recent_timestamp(configpath, arrayid):
+    """ Returns the most recent diagnostic timestamp for the array in ms """
+    conn = get_connection(configpath)
+
+    return conn.performance.get_last_available_timestamp(array_id=arrayid)
+
+
+def wait_for_new_interval(configpath, arrayid, last_interval, deadline):
+    """ Cheap check for a new diagnostic interval before we sweep, returns
+        the most recent timestamp (ms) or None if nothing new appeared """
+    logger = logging.getLogger('discovery')
+    give_up = min(time.time() + interval_wait, deadline)
+
+    while True:
+        recent_time = get_recent_timestamp(configpath, arrayid)
+        if not last_interval or recent_time > last_interval:
+            return recent_time
+
+        if time.time() + interval_poll > give_up:
+            logger.info(f"No new interval since {last_interval}")
+            return None
+
+        logger.info(f"No new interval since {last_interval}, waiting "
+                    f"{interval_poll} seconds")
+        time.sleep(interval_poll)
+
+
 def gather_array_health(configpath, arrayid):
     """ Collects Array Health Scores """
     logger = logging.getLogger('discovery')
     logger.info("Starting Health Score Gathering")
 
-    PyU4V.univmax_conn.file_path = configpath
-    conn = PyU4V.U4VConn()
+    conn = get_connection(configpath)
 
     logger.debug("Collecting Health")
     health = conn.system.get_system_health(array_id=arrayid)
@@ -124,88 +692,422 @@ def gather_array_health(configpath, arrayid):
                          f"{score} - {timestamp}")
             health_metric = ZabbixMetric(host, metric_key, score, timestamp)
 
-            ZabbixSender(zabbix_server=zabbix_ip,
-                         zabbix_port=zabbix_port).send([health_metric])
+            send_to_zabbix([health_metric])
         else:
             logger.debug(f"No health score available for {i['metric']}")
+
+    flush_zabbix()
     logger.info("Completed Health Score Gathering")
 
 
-def process_perf_results(metrics, category):
-    """ Process metrics collected from the _stats function by category """
+# This dict maps the category to the identifiers in the result set
+# that are used in identifiers for Zabbix keys
+category_map = {"Array": ["array_id"],
+                "FEDirector": ["director_id"],
+                "FEPort": ["director_id", "port_id"],
+                "BEDirector": ["director_id"],
+                "BEPort": ["director_id", "port_id"],
+                "RDFDirector": ["director_id"],
+                "RDFPort": ["director_id", "port_id"],
+                "IMDirector": ["director_id"],
+                "EDSDirector": ["director_id"],
+                "StorageGroup": ["storage_group_id"],
+                "SRP": ["srp_id"],
+                "Board": ["board_id"],
+                "DiskGroup": ["disk_group_id"],
+                "PortGroup": ["port_group_id"],
+                "BeEmulation": ["be_emulation_id"],
+                "FeEmulation": ["fe_emulation_id"],
+                "EDSEmulation": ["eds_emulation_id"],
+                "IMEmulation": ["im_emulation_id"],
+                "RDFEmulation": ["rdf_emulation_id"],
+                "Host": ["host_id"],
+                "Initiator": ["initiator_id"],
+                "RDFA": ["ra_group_id"],
+                "RDFS": ["rs_group_id"],
+                "ISCSITarget": ['iscsi_target_id']
+                }
+
+
+def perf_identifier(metrics, category):
+    """ Build the identifier used in Zabbix keys for a _stats result """
+    return "-".join(metrics[i] for i in category_map[category])
+
+
+def build_metrics(host, cat, ident, metric_data, timestamp, metric_keys,
+                  debug=False):
+    """ Yields a ZabbixMetric for every metric in a sample, the keys are
+        cached in metric_keys as they're the same for every sample of an
+        object """
+    logger = logging.getLogger('discovery')
+
+    for metric, score in metric_data.items():
+        try:
+            key = metric_keys[metric]
+        except KeyError:
+            if 'timestamp' in metric:    # ignore the second timestamp
+                key = None
+            else:
+                key = generate_metric_key(key_base, cat, metric, ident)
+            metric_keys[metric] = key
+
+        if key is None:
+            continue
+
+        if debug:
+            logger.debug(f"Built Metric: {key} for {host} - ts: {timestamp}")
+        yield ZabbixMetric(host, key, score, timestamp)
+
+
+def process_perf_results(metrics, category, window=None, ident=None):
+    """ Process metrics collected from the _stats function by category
+        returns the newest timestamp (ms) found in the results.  If a
+        window (start, end) is passed only samples after start and up to
+        and including end are sent.  The identifier is built from the
+        results unless passed """
     logger = logging.getLogger('discovery')
     host = host_base.format(arrayid=metrics['array_id'])
 
-    # This dict maps the category to the identifiers in the result set
-    # that are used in identifiers for Zabbix keys
-    category_map = {"Array": ["array_id"],
-                    "FEDirector": ["director_id"],
-                    "FEPort": ["director_id", "port_id"],
-                    "BEDirector": ["director_id"],
-                    "BEPort": ["director_id", "port_id"],
-                    "RDFDirector": ["director_id"],
-                    "RDFPort": ["director_id", "port_id"],
-                    "IMDirector": ["director_id"],
-                    "EDSDirector": ["director_id"],
-                    "StorageGroup": ["storage_group_id"],
-                    "SRP": ["srp_id"],
-                    "Board": ["board_id"],
-                    "DiskGroup": ["disk_group_id"],
-                    "PortGroup": ["port_group_id"],
-                    "BeEmulation": ["be_emulation_id"],
-                    "FeEmulation": ["fe_emulation_id"],
-                    "EDSEmulation": ["eds_emulation_id"],
-                    "IMEmulation": ["im_emulation_id"],
-                    "RDFEmulation": ["rdf_emulation_id"],
-                    "Host": ["host_id"],
-                    "Initiator": ["initiator_id"],
-                    "RDFA": ["ra_group_id"],
-                    "RDFS": ["rs_group_id"],
-                    "ISCSITarget": ['iscsi_target_id']
-                    }
-
-    # Based on category, pull our our identifiers and format
-    id_values = list()
-    for i in category_map[category]:
-        id_values.append(metrics[i])
-
-    ident = "-".join(id_values)
+    if ident is None:
+        ident = perf_identifier(metrics, category)
     cat = category.lower()
 
+    # A 24 hour preload is hundreds of samples per object with the same
+    # metrics in each, so build the keys once per object rather than per
+    # value and skip formatting debug messages nobody will see
+    debug = logger.isEnabledFor(logging.DEBUG)
+    metric_keys = dict()    # Metric name to key, None for timestamps
+    master_key = generate_master_key(key_base, cat, ident)
+    timestamp_fields = None
+
+    newest = None
     for metric_data in metrics['result']:
 
+        # Skip anything outside our backfill window, it's already been sent
+        if window and not window[0] < metric_data['timestamp'] <= window[1]:
+            continue
+
+        newest = max(newest or 0, metric_data['timestamp'])
+
         # Drop the ms from our timestamp, we've only got
         # 5 minute granularity at best here
         timestamp = fix_ts(metric_data['timestamp'])
 
-        send_metrics = list()
-        # Bundle up all our metrics into a single list to send to Zabbix
-        for metric, score in metric_data.items():
-            if 'timestamp' in metric:    # ignore the second timestamp
+        if json_master_items:
+            # One document per timestamp, dependent items pull it apart
+            if timestamp_fields is None:
+                timestamp_fields = [metric for metric in metric_data
+                                    if 'timestamp' in metric]
+            values = dict(metric_data)
+            for field in timestamp_fields:
+                values.pop(field, None)
+
+            if debug:
+                logger.debug(f"Built Master: {master_key} for {host} - "
+                             f"ts: {timestamp}")
+            send_to_zabbix([ZabbixMetric(host, master_key,
+                                         json_dumps(values), timestamp)])
+        else:
+            # Queue our metrics straight onto the send buffer, they're
+            # sent once we have a chunk
+            send_to_zabbix(build_metrics(host, cat, ident, metric_data,
+                                         timestamp, metric_keys, debug))
+
+        if sample_cache is not None:
+            cache_sample(metrics['array_id'], category, ident, metric_data)
+
+    logger.debug("Completed queueing Metrics")
+
+    return newest
+
+
+def cache_sample(arrayid, category, ident, metric_data):
+    """ Keep the sample for --serve if it's the newest we have seen """
+    global cache_version
+
+    with cache_lock:
+        cached = sample_cache.get((category, ident))
+        if cached and cached['timestamp'] >= metric_data['timestamp']:
+            return
+
+        sample_cache[(category, ident)] = {
+            'array_id': arrayid,
+            'category': category,
+            'id': ident,
+            'timestamp': metric_data['timestamp'],
+            'metrics': {metric: score for metric, score in metric_data.items()
+                        if 'timestamp' not in metric}}
+        cache_version += 1
+
+
+def expire_samples():
+    """ Drop cached samples that have fallen cache_expiry intervals behind
+        the newest, going by array time rather than our clock """
+    global cache_version
+    logger = logging.getLogger('discovery')
+
+    with cache_lock:
+        if not sample_cache:
+            return
+        newest = max(s['timestamp'] for s in sample_cache.values())
+        oldest = newest - cache_expiry * collection_interval * 60 * 1000
+
+        expired = [key for key, sample in sample_cache.items()
+                   if sample['timestamp'] < oldest]
+        for key in expired:
+            del sample_cache[key]
+        if expired:
+            cache_version += 1
+
+    if expired:
+        logger.info(f"Expired {len(expired)} cached samples")
+
+
+def escape_label(value):
+    """ Escape a label value for OpenMetrics """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def render_samples(fmt, category=None):
+    """ Render the cached samples as JSON or OpenMetrics, optionally for
+        a single category.  Returns the body and the version it's from """
+    with cache_lock:
+        version = cache_version
+        samples = [s for s in sample_cache.values()
+                   if category is None or s['category'] == category]
+
+    samples.sort(key=lambda s: (s['category'], s['id']))
+
+    if fmt == 'json':
+        return json_dumps({'samples': samples}), version
+
+    # OpenMetrics needs every sample of a metric family together
+    families = collections.defaultdict(list)
+    for sample in samples:
+        labels = ",".join(
+            f'{label}="{escape_label(sample[field])}"' for label, field in
+            [('array', 'array_id'), ('category', 'category'), ('id', 'id')])
+        for metric, score in sample['metrics'].items():
+            if not isinstance(score, (int, float)):
                 continue
+            name = re.sub(r'[^a-zA-Z0-9_]', '_',
+                          f"powermax_{sample['category']}_{metric}").lower()
+            families[name].append(f"{name}{{{labels}}} {score} "
+                                  f"{fix_ts(sample['timestamp'])}")
+
+    lines = list()
+    for name, family in families.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(family)
+    lines.append("# EOF")
+
+    return "\n".join(lines) + "\n", version
+
+
+class SampleRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Serves the cached samples, so other tools can read the latest data
+        without going to Unisphere
+
+        /samples[/<category>]  JSON
+        /metrics[/<category>]  OpenMetrics
+    """
+
+    content_types = {
+        'json': 'application/json',
+        'openmetrics': 'application/openmetrics-text; version=1.0.0; '
+                       'charset=utf-8'}
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        fmt = {'samples': 'json', 'metrics': 'openmetrics'}.get(parts[0])
+        if not fmt or len(parts) > 2:
+            self.send_error(404)
+            return
+        category = parts[1] if len(parts) == 2 else None
+
+        # The ETag only changes when a new sample arrives, so a matching
+        # If-None-Match means the client already has this data
+        etag = f'"{cache_version}-{fmt}-{category}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
 
-            key = generate_metric_key(key_base, cat, metric, ident)
+        body, version = render_samples(fmt, category)
+        body = body.encode('utf-8')
 
-            logger.debug(f"Built Metric: {key} for {host} - ts: {timestamp}")
-            send_metrics.append(ZabbixMetric(host, key, score, timestamp))
+        self.send_response(200)
+        self.send_header('Content-Type', self.content_types[fmt])
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', f'"{version}-{fmt}-{category}"')
+        self.end_headers()
+        self.wfile.write(body)
 
-        logger.debug("Sending Metrics")
+    def log_message(self, format, *args):
+        logger = logging.getLogger('discovery')
+        logger.debug(f"HTTP {self.address_string()} {format % args}")
 
-        # Send the actual metrics list
-        res = ZabbixSender(zabbix_server=zabbix_ip,
-                           zabbix_port=zabbix_port).send(send_metrics)
-        logger.info(res)
 
-    logger.debug("Completed sending Metrics")
+class SampleServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """ Threaded HTTP server for the sample cache """
+    daemon_threads = True
+
+
+def start_sample_server(port):
+    """ Enable the sample cache and serve it over HTTP in the background """
+    global sample_cache
+    logger = logging.getLogger('discovery')
+
+    sample_cache = dict()
+    server = SampleServer((serve_address, port), SampleRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    logger.info(f"Serving cached samples on {serve_address}:{port}")
+    return server
+
+
+def get_ranking(state, category):
+    """ Returns the ranking kept in the state for a limited category, top
+        maps the top objects to when they were promoted (epoch secs) """
+    rankings = state.setdefault('ranking', dict())
+    ranking = rankings.setdefault(category, dict())
+    ranking.setdefault('objects', dict())
+    ranking.setdefault('cursor', 0)
+    ranking.setdefault('top', dict())
+    return ranking
+
+
+def select_ranked(category, idents, ranking):
+    """ Choose the objects to collect for a limited category, returns the
+        top identifiers and those collected only to refresh their ranking """
+    limit = cardinality_limits[category]
+    objects = ranking['objects']
+    top = ranking['top']
+
+    # Forget anything that has been removed from the array
+    for ident in set(objects) - set(idents):
+        del objects[ident]
+    for ident in set(top) - set(idents):
+        del top[ident]
+
+    rest = sorted(set(idents) - set(top))
+
+    # Objects never ranked go first, then round robin through the others
+    rotate = [i for i in rest if i not in objects][:limit['rotate']]
+    ranked = [i for i in rest if i in objects]
+    if ranked:
+        cursor = ranking['cursor'] % len(ranked)
+        count = min(limit['rotate'] - len(rotate), len(ranked))
+        rotate += (ranked[cursor:] + ranked[:cursor])[:count]
+        ranking['cursor'] = cursor + count
+
+    return sorted(top), rotate
+
+
+def established_top(ranking):
+    """ Returns the top objects promoted long enough ago that discovery
+        has created their items, only these are sent on their own """
+    cutoff = time.time() - promotion_delay * 60
+    return {i for i, promoted in ranking['top'].items() if promoted <= cutoff}
+
+
+def update_top(category, ranking):
+    """ Work out the top objects from the latest rankings, an incumbent is
+        only replaced when it's beaten by more than promotion_margin """
+    limit = cardinality_limits[category]
+    objects = ranking['objects']
+    top = ranking['top']
+
+    def kpi(ident):
+        return objects[ident]['kpi']
+
+    for ident in [i for i in top if i not in objects]:
+        del top[ident]
+    while len(top) > limit['top']:
+        del top[min(top, key=kpi)]
+
+    now = int(time.time())
+    challengers = sorted((i for i in objects if i not in top), key=kpi,
+                         reverse=True)
+    for ident in challengers:
+        if len(top) < limit['top']:
+            top[ident] = now
+            continue
+
+        weakest = min(top, key=kpi)
+        if kpi(ident) <= kpi(weakest) * (1 + promotion_margin):
+            break
+        del top[weakest]
+        top[ident] = now
+
+
+def rank_perf_results(metrics, category, ranking, ident):
+    """ Record the latest sample of an object against its ranking, returns
+        the sample timestamp or None if it couldn't be ranked """
+    if not metrics['result']:
+        return None
+
+    sample = max(metrics['result'], key=lambda m: m['timestamp'])
+    kpi = cardinality_limits[category]['kpi']
+    if kpi not in sample:
+        return None
+
+    ranking['objects'][ident] = {
+        'kpi': sample[kpi],
+        'timestamp': sample['timestamp'],
+        'metrics': {metric: score for metric, score in sample.items()
+                    if 'timestamp' not in metric}}
+    return sample['timestamp']
 
 
-def gather_dir_perf(configpath, arrayid, category, hours=None):
-    """ Collects Director Level Performance Statistics """
+def send_other_aggregate(arrayid, category, rankings, timestamp):
+    """ Fold everything not sent on its own into a single "other" object,
+        using the latest sample we have for each from every ranking passed.
+        Objects not sampled within other_max_age intervals are left out """
+    logger = logging.getLogger('discovery')
+
+    if not timestamp:
+        return
+
+    oldest = timestamp - other_max_age * collection_interval * 60 * 1000
+    others = list()
+    for ranking in rankings:
+        sent = established_top(ranking)
+        others += [o['metrics'] for i, o in ranking['objects'].items()
+                   if i not in sent and o['timestamp'] >= oldest]
+    if not others:
+        return
+
+    aggregate = {'timestamp': timestamp}
+    for metric in set().union(*others):
+        values = [o[metric] for o in others
+                  if isinstance(o.get(metric), (int, float))]
+        if not values:
+            continue
+        aggregate[metric] = sum(values)
+        if any(a in metric for a in average_metrics):
+            aggregate[metric] /= len(values)
+
+    logger.info(f"Sending {category} other aggregate of {len(others)} "
+                f"objects")
+    process_perf_results({'array_id': arrayid, 'result': [aggregate]},
+                         category, ident='other')
+
+
+def gather_dir_perf(configpath, arrayid, category, hours=None, window=None,
+                    items=None, deadline=None):
+    """ Collects Director Level Performance Statistics
+
+        Only the directors in items are collected if passed, and once the
+        deadline (epoch secs) passes no further directors are started.
+        Returns the newest timestamp (ms) collected, or None, and the list
+        of directors left over """
     logger = logging.getLogger('discovery')
     logger.info(f"Starting {category} Perf Stats Collection")
 
-    PyU4V.univmax_conn.file_path = configpath
-    conn = PyU4V.U4VConn()
+    conn = get_connection(configpath)
 
     # Map our function to to it's matching ports
     # FEDirector = FEPorts, etc..
@@ -242,13 +1144,23 @@ def gather_dir_perf(configpath, arrayid, category, hours=None):
     # Gather the keys for the director, this will throw an exception if
     # the box doesn't have a specific director type (like RDF)
     try:
-        directors = func_map[category]['keys'](array_id=arrayid)
+        if items is None:
+            items = func_map[category]['keys'](array_id=arrayid)
+        directors = items
         logger.debug(directors)
     except PyU4V.utils.exception.ResourceNotFoundException:
         logger.info(f"No {category} Directors found")
+        return None, list()
+
+    newest = None
+    for index, director in enumerate(directors):
+        if deadline and time.time() > deadline:
+            logger.warning(f"Run budget exceeded during {category}, "
+                           f"{len(directors) - index} directors left over")
+            return newest, directors[index:]
 
-    for director in directors:
         dir_id = director['directorId']
+        dir_owned = shard_owns(category, dir_id)
         logger.info(f"Collecting for {category} director {dir_id}")
 
         # this will be the kwargs passed to the stats function when called
@@ -266,18 +1178,29 @@ def gather_dir_perf(configpath, arrayid, category, hours=None):
             metric_params['start_time'] = start_time
             metric_params['end_time'] = end_time
 
+        # Backfilling a specific window, recency doesn't apply here
+        if window:
+            metric_params['start_time'], metric_params['end_time'] = window
+            del metric_params['recency']
+
         # Gather metrics, but gracefully handle if they're not recent enough
+        # a failure here shouldn't stop us collecting the director's ports
         try:
-            metrics = func_map[category]['stats'](**metric_params)
+            metrics = None
+            if dir_owned:
+                metrics = func_map[category]['stats'](**metric_params)
 
-        except PyU4V.utils.exception.VolumeBackendAPIException:
-            logger.info("Current metrics do not meet recency requirements")
-            break
+        except (PyU4V.utils.exception.VolumeBackendAPIException,
+                PyU4V.utils.exception.ResourceNotFoundException):
+            logger.info(f"Metrics not read for {dir_id}, recency not met "
+                        f"or director offline")
 
-        logger.debug(metrics)
+        if metrics:
+            logger.debug(metrics)
 
-        # Send them off to be processed and sent to Zabbix
-        process_perf_results(metrics, category)
+            # Send them off to be processed and sent to Zabbix
+            ts = process_perf_results(metrics, category, window)
+            newest = max(newest or 0, ts or 0) or None
 
         # Port Level Stats (if they exist) follows the same pattern
         # but not all directors have ports (EDS and IM for ex.)
@@ -294,29 +1217,43 @@ def gather_dir_perf(configpath, arrayid, category, hours=None):
 
         for port in ports:
             port_id = port['portId']
+            if not shard_owns(port_cat, f"{dir_id}-{port_id}"):
+                continue
+
             logger.info(f"Collecting metrics for {category}"
                         f" {dir_id} port {port_id}")
             try:
                 metric_params['port_id'] = port_id
                 metrics = func_map[port_cat]['stats'](**metric_params)
-            except PyU4V.utils.exception.VolumeBackendAPIException:
-                logger.info("Metrics not read, recency not met")
+            except (PyU4V.utils.exception.VolumeBackendAPIException,
+                    PyU4V.utils.exception.ResourceNotFoundException):
+                logger.info(f"Metrics not read for {dir_id} port {port_id}, "
+                            f"recency not met or port offline")
                 continue
 
             logger.debug(metrics)
 
-            process_perf_results(metrics, port_cat)
+            ts = process_perf_results(metrics, port_cat, window)
+            newest = max(newest or 0, ts or 0) or None
 
     logger.info("Completed Director Performance Gathering")
+    return newest, list()
 
 
-def gather_perf(configpath, arrayid, category, hours=None):
-    """ Generalized non-Director performance gathering """
+def gather_perf(configpath, arrayid, category, hours=None, window=None,
+                items=None, deadline=None, ranking=None):
+    """ Generalized non-Director performance gathering
+
+        Only the objects in items are collected if passed, and once the
+        deadline (epoch secs) passes no further objects are started.
+        Categories in cardinality_limits are limited to their top objects
+        when their ranking from the state is passed.
+        Returns the newest timestamp (ms) collected, or None, and the list
+        of objects left over """
     logger = logging.getLogger('discovery')
     logger.info(f"Starting {category} Stats Collection ")
 
-    PyU4V.univmax_conn.file_path = configpath
-    conn = PyU4V.U4VConn()
+    conn = get_connection(configpath)
 
     # Map our categories to functions and what arguments map to responses
     func_map = {'PortGroup':
@@ -385,16 +1322,51 @@ def gather_perf(configpath, arrayid, category, hours=None):
                  'args': {}}
                 }
 
+    # Already limited if they've been carried over from a previous run
+    limited = ranking is not None and category in cardinality_limits
+    limited = limited and items is None
+
     try:
-        if 'Array' not in category:
+        if items is not None:
+            pass    # Carried over from a previous run
+        elif 'Array' not in category:
             items = func_map[category]['keys'](array_id=arrayid)
         else:
             # Special case, array object can't have array_id passed
             items = func_map[category]['keys']()
-        logger.debug(items)
     except PyU4V.utils.exception.ResourceNotFoundException:
         logger.info(f"No {category} found")
-        return
+        return None, list()
+
+    def item_ident(item):
+        args = func_map[category]['args'].values()
+        return "-".join(item[a] for a in args)
+
+    # Only keep the objects that belong to this shard
+    if shard_count > 1:
+        items = [i for i in items if shard_owns(category, item_ident(i))]
+
+    # Only established top objects are sent on their own, the rest of the
+    # top and the rotation are collected to keep the ranking current and
+    # make up "other".  Backfills and preloads only send established top
+    # objects and leave the ranking alone, their samples are older
+    ranking_run = limited and not (hours or window)
+    send = None
+    if limited:
+        by_ident = {item_ident(i): i for i in items}
+        send = established_top(ranking) & set(by_ident)
+        if ranking_run:
+            top, rotate = select_ranked(category, list(by_ident), ranking)
+            collect = top + rotate
+        else:
+            top, rotate, collect = sorted(send), list(), sorted(send)
+        items = [by_ident[i] for i in collect]
+        logger.info(f"Limiting {category} to {len(top)} top objects "
+                    f"({len(send)} sent on their own) and {len(rotate)} "
+                    f"in rotation")
+
+    # Don't dump the full list, it can be tens of thousands of initiators
+    logger.info(f"Collecting {len(items)} {category} objects")
 
     # this will be the kwargs passed to the stats function when called
     metric_params = {'recency': metric_recency,
@@ -409,10 +1381,25 @@ def gather_perf(configpath, arrayid, category, hours=None):
         metric_params['start_time'] = start_time
         metric_params['end_time'] = end_time
 
+    # Backfilling a specific window, recency doesn't apply here
+    if window:
+        metric_params['start_time'], metric_params['end_time'] = window
+        del metric_params['recency']
+
     if 'Array' not in category:
         metric_params['array_id'] = arrayid
 
-    for item in items:
+    newest = None
+    ranked_newest = None
+    unranked = 0
+    for index, item in enumerate(items):
+        if deadline and time.time() > deadline:
+            logger.warning(f"Run budget exceeded during {category}, "
+                           f"{len(items) - index} objects left over")
+            # No point carrying over objects we weren't going to send
+            return newest, [i for i in items[index:]
+                            if send is None or item_ident(i) in send]
+
         # We need to dynamically update the dict we're using for kwargs
         # to include the appropriate parameters for this category item
         for m_key, i_key in func_map[category]['args'].items():
@@ -425,43 +1412,225 @@ def gather_perf(configpath, arrayid, category, hours=None):
             metrics = func_map[category]['stats'](**metric_params)
             logger.debug("Metrics returned")
             logger.debug(metrics)
-        except PyU4V.utils.exception.VolumeBackendAPIException:
-            logger.info(f"Metrics not read for {category}, recency not met")
-            return
+        except (PyU4V.utils.exception.VolumeBackendAPIException,
+                PyU4V.utils.exception.ResourceNotFoundException):
+            # Don't let one object take the rest of the category with it
+            logger.info(f"Metrics not read for {category} {item}, "
+                        f"recency not met or object removed")
+            continue
+
+        if ranking_run:
+            ts = rank_perf_results(metrics, category, ranking,
+                                   item_ident(item))
+            ranked_newest = max(ranked_newest or 0, ts or 0) or None
+            unranked += bool(metrics['result'] and not ts)
 
-        process_perf_results(metrics, category)
+        if send is not None and item_ident(item) not in send:
+            continue
+
+        ts = process_perf_results(metrics, category, window)
+        newest = max(newest or 0, ts or 0) or None
+
+    if ranking_run:
+        if unranked:
+            kpi = cardinality_limits[category]['kpi']
+            logger.warning(f"{unranked} {category} objects have no {kpi} "
+                           f"metric to rank by, check cardinality_limits")
+        # A sharded category has one "other", the first shard builds it
+        # from every shard's rankings rather than each sending a part
+        if shard_count == 1 or category not in sharded_categories:
+            send_other_aggregate(arrayid, category, [ranking],
+                                 newest or ranked_newest)
+        elif shard_index == 0:
+            rankings = [ranking] + list(shard_rankings(
+                arrayid, category, shard_count, skip=shard_index))
+            send_other_aggregate(arrayid, category, rankings,
+                                 newest or ranked_newest)
+        update_top(category, ranking)
 
     logger.info(f"Completed {category} Stats Collection")
+    return newest, list()
+
+
+def gather_category(configpath, arrayid, category, state=None, **kwargs):
+    """ Send a category to the right gather function, returning the newest
+        timestamp and the leftover objects.  Leftovers are None if the
+        whole category failed, one category failing shouldn't take the
+        rest of the run with it.  A category Zabbix didn't accept all of
+        has failed too, so it's left to the gap backfill to resend """
+    global send_failures
+    logger = logging.getLogger('discovery')
+
+    if 'Director' in category:
+        gather_func = gather_dir_perf
+    else:
+        gather_func = gather_perf
+        if state is not None and category in cardinality_limits:
+            kwargs['ranking'] = get_ranking(state, category)
+
+    send_failures = 0
+    try:
+        result = gather_func(configpath, arrayid, category, **kwargs)
+    except Exception:
+        logger.exception(f"Collection failed for {category}")
+        result = None, None
+    finally:
+        flush_zabbix()
+
+    if send_failures:
+        logger.warning(f"Zabbix didn't accept all of {category}, it will be "
+                       f"backfilled once Zabbix is back")
+        return None, None
+    return result
+
+
+def category_priority(category):
+    """ Sort key for categories based on collection_priority """
+    if category in collection_priority:
+        return collection_priority.index(category)
+    return len(collection_priority)
+
+
+def collect_backfill(configpath, arrayid, state, deadline=None):
+    """ Collect any queued backfill and carried over windows in priority
+        order, anything we don't get to stays queued for the next run """
+    logger = logging.getLogger('discovery')
+
+    pending = sorted(state['backfill'],
+                     key=lambda b: (category_priority(b['category']),
+                                    b['start']))
+    state['backfill'] = list()
+
+    for backfill in pending:
+        category = backfill['category']
+
+        if deadline and time.time() > deadline:
+            state['backfill'].append(backfill)
+            continue
+
+        window = (backfill['start'], backfill['end'])
+        logger.info(f"Backfilling {category} from {window[0]} to {window[1]}")
+
+        newest, leftover = gather_category(configpath, arrayid, category,
+                                           state=state, window=window,
+                                           items=backfill['items'],
+                                           deadline=deadline)
+
+        if leftover is None:
+            state['backfill'].append(backfill)
+        elif leftover:
+            state['backfill'].append(dict(backfill, items=leftover))
+
+        # Current collection may have failed for this category, so move
+        # our last collected marker forward to avoid backfilling twice
+        if newest and newest > state['categories'].get(category, 0):
+            state['categories'][category] = newest
+
+    logger.info(f"Completed Backfill, {len(state['backfill'])} windows "
+                f"carried over")
+
+
+def collect_stats(configpath, arrayid, hours=None):
+    """ Run a full stats collection for the array, in priority order and
+        within the run budget """
+    logger = logging.getLogger('discovery')
+
+    # Explicit preloads don't save the state and aren't on a budget, the
+    # state is only read for the rankings of limited categories
+    if hours:
+        logger.info(f"Precollecting {hours} worth of statistics")
+        state = load_state(arrayid)
+        if shard_owns('Health', None):
+            gather_array_health(configpath, arrayid)
+        for category in collection_priority:
+            if shard_has_work(category):
+                gather_category(configpath, arrayid, category, state=state,
+                                hours=hours)
+        return
+
+    deadline = time.time() + run_budget
+
+    state = load_state(arrayid)
+
+    # Health scores don't depend on the diagnostic interval
+    if shard_owns('Health', None):
+        gather_array_health(configpath, arrayid)
+
+    # If we can't tell whether there's a new interval sweep anyway, as we
+    # would have before the check, using our clock for any carry over
+    probed = True
+    try:
+        recent_time = wait_for_new_interval(
+            configpath, arrayid, state.get('last_interval'), deadline)
+    except Exception:
+        logger.exception("Unable to check for a new interval, sweeping "
+                         "anyway")
+        recent_time = int(time.time() * 1000)
+        probed = False
+
+    # Nothing new to sweep, but there may still be carried over work
+    if not recent_time:
+        collect_backfill(configpath, arrayid, state, deadline)
+        save_state(arrayid, state)
+        return
+
+    # Work out what we've missed since the last run
+    if probed:
+        detect_gaps(state, recent_time)
+        state['last_interval'] = recent_time
+
+    # If we run out of time the rest of the current interval is carried
+    # over, limited to the most recent sample
+    carry_over = {'start': recent_time - collection_interval * 60 * 1000,
+                  'end': recent_time}
+
+    for category in collection_priority:
+        if not shard_has_work(category):
+            continue
+
+        if time.time() > deadline:
+            logger.warning(f"Run budget exceeded, carrying over {category}")
+            state['backfill'].append(dict(carry_over, category=category,
+                                          items=None))
+            continue
+
+        newest, leftover = gather_category(configpath, arrayid, category,
+                                           state=state, deadline=deadline)
+        if newest:
+            state['categories'][category] = newest
+        if leftover:
+            state['backfill'].append(dict(carry_over, category=category,
+                                          items=leftover))
+
+    # Current data is out the door, now fill in any gaps
+    collect_backfill(configpath, arrayid, state, deadline)
+    save_state(arrayid, state)
 
 
 def do_array_discovery(configpath, arrayid):
-    """ Perform a discovery of the array attached to U4V """
+    """ Perform a discovery of the array attached to U4V, yields the LLD
+        entries as they are found """
     logger = logging.getLogger('discovery')
     logger.info("Starting discovery for Array")
 
-    PyU4V.univmax_conn.file_path = configpath
-    conn = PyU4V.U4VConn()
+    conn = get_connection(configpath)
 
-    result = list()
     arrays_in_uni = conn.common.get_array_list()
     logger.debug(arrays_in_uni)
 
-    if arrayid in conn.common.get_array_list():
-
-        result.append({'{#ARRAYID}': arrayid})
-        logger.debug(result)
+    if arrayid in arrays_in_uni:
+        yield {'{#ARRAYID}': arrayid}
 
     logger.info("Completed discovery for Array")
-    return result
 
 
 def do_director_discovery(configpath, arrayid, category, ports=False):
-    """ Perform a discovery of all the Directors in the array """
+    """ Perform a discovery of all the Directors in the array, yields the
+        LLD entries as they are found """
     logger = logging.getLogger('discovery')
     logger.info(f"Starting discovery for {category}")
 
-    PyU4V.univmax_conn.file_path = configpath
-    conn = PyU4V.U4VConn()
+    conn = get_connection(configpath)
 
     func_map = {'FEDirector':
                 {'id': '',
@@ -482,7 +1651,6 @@ def do_director_discovery(configpath, arrayid, category, ports=False):
                 {'id': 'IM',
                  'keys': conn.performance.get_im_director_keys}}
 
-    result = list()
     directors = func_map[category]['keys'](array_id=arrayid)
     logger.debug(directors)
 
@@ -494,43 +1662,37 @@ def do_director_discovery(configpath, arrayid, category, ports=False):
         dir_key = f"{{#{func_map[category]['id']}DIRID}}"
 
         if not ports:
-            result.append({'{#ARRAYID}': arrayid, dir_key: dir_id})
+            yield {'{#ARRAYID}': arrayid, dir_key: dir_id}
         else:
             # Now we find our director ports
             if 'ports' in func_map[category]:
-                ports = list()
+                dir_ports = list()
                 try:
-                    ports = func_map[category]['ports'](array_id=arrayid,
-                                                        director_id=dir_id)
-                    logger.debug(ports)
+                    dir_ports = func_map[category]['ports'](
+                        array_id=arrayid, director_id=dir_id)
+                    logger.debug(dir_ports)
                 except PyU4V.utils.exception.ResourceNotFoundException:
                     logger.info(f"No ports found for director {dir_id}")
 
                 port_key = f"{{#{func_map[category]['id']}PORTID}}"
-                if ports:
-                    for port in ports:
-                        port_id = f"{dir_id}-{port['portId']}"
-                        result.append({'{#ARRAYID}': arrayid,
-                                       port_key: port_id})
+                for port in dir_ports:
+                    port_id = f"{dir_id}-{port['portId']}"
+                    yield {'{#ARRAYID}': arrayid, port_key: port_id}
 
-    logger.debug(result)
     logger.info(f"Completed discovery for {category}")
 
-    return result
-
 
 def do_item_discovery(configpath, arrayid, category):
-    """ Perform discoveyr of items on the array """
+    """ Perform discovery of items on the array, yields the LLD entries
+        as they are found """
     logger = logging.getLogger('discovery')
     logger.info(f"Starting item discovery for {category}")
 
     if 'Array' in category:  # Special case for array
-        return do_array_discovery(configpath, arrayid)
-
-    PyU4V.univmax_conn.file_path = configpath
-    conn = PyU4V.U4VConn()
+        yield from do_array_discovery(configpath, arrayid)
+        return
 
-    result = list()
+    conn = get_connection(configpath)
 
     func_map = {'PortGroup': {
                     'keys': conn.performance.get_port_group_keys,
@@ -596,19 +1758,65 @@ def do_item_discovery(configpath, arrayid, category):
 
     try:
         items = func_map[category]['keys'](array_id=arrayid)
-        logger.debug(items)
     except PyU4V.utils.exception.ResourceNotFoundException:
         logger.info(f"No {category} items found")
-        return list()
+        return
+
+    logger.info(f"Found {len(items)} {category} items")
+
+    # Limited categories only get items for the top objects, the rest
+    # are reported under other
+    item_key = f"{{#{func_map[category]['id']}}}"
+    if category in cardinality_limits:
+        top = load_rankings(arrayid, category)
+        items = [i for i in items
+                 if i[func_map[category]['idparam']] in top]
+        items.append({func_map[category]['idparam']: 'other'})
+        logger.info(f"Limited to {len(items) - 1} top {category} items")
 
     for item in items:
-        item_key = f"{{#{func_map[category]['id']}}}"
-        result.append({'{#ARRAYID}': arrayid,
-                      item_key: item[func_map[category]['idparam']]})
+        entry = {'{#ARRAYID}': arrayid,
+                 item_key: item[func_map[category]['idparam']]}
+        logger.debug(entry)
+        yield entry
 
-    logger.debug(result)
     logger.info(f"Completed discovery for {category}")
-    return result
+
+
+def serve_stats(configpath, arrayid, port, hours=None):
+    """ Collect every interval forever, serving the latest samples """
+    logger = logging.getLogger('discovery')
+
+    start_sample_server(port)
+
+    while True:
+        started = time.time()
+
+        # A bad run shouldn't take the endpoint down, try again next time
+        try:
+            collect_stats(configpath, arrayid, hours=hours)
+        except Exception:
+            logger.exception("Collection failed, retrying next interval")
+        hours = None    # Only preload on the first run
+
+        expire_samples()
+
+        wait = collection_interval * 60 - (time.time() - started)
+        logger.info(f"Next collection in {max(wait, 0):.0f} seconds")
+        time.sleep(max(wait, 0))
+
+
+def parse_shard(value):
+    """ Parse a --shard I/N argument, returns the 0 based index and count """
+    try:
+        index, count = [int(i) for i in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} is not in the form I/N")
+
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"Shard {index} is not 1 to {count}")
+
+    return index - 1, count
 
 
 def main():
@@ -632,6 +1840,29 @@ def main():
     parser.add_argument('--hours', action='store', type=int, choices=range(25),
                         help="Preload hours of data into Zabbix (Up to 24)")
 
+    parser.add_argument('--serve', action='store', type=int, metavar='PORT',
+                        help="Run as a daemon, collecting every interval and "
+                             "serving the latest samples over HTTP on PORT")
+
+    parser.add_argument('--shard', action='store', type=parse_shard,
+                        metavar='I/N',
+                        help="Collect only shard I of N (e.g. 1/4), run one "
+                             "collector per shard to split a large array")
+
+    cgroup = parser.add_mutually_exclusive_group()
+
+    cgroup.add_argument('--record', action='store', metavar='CASSETTE',
+                        help="Record Unisphere responses to a cassette file")
+
+    cgroup.add_argument('--replay', action='store', metavar='CASSETTE',
+                        help="Replay Unisphere responses from a cassette "
+                             "file, nothing is sent to Zabbix")
+
+    parser.add_argument('--replay-speed', action='store', type=float,
+                        default=1.0,
+                        help="Replay at this multiple of the recorded "
+                             "latency, 0 for no delay (Default 1.0)")
+
     dgroup = parser.add_mutually_exclusive_group()
 
     dgroup.add_argument('--FEPort', action='store_true',
@@ -692,14 +1923,31 @@ def main():
 
     logger.info("Arguments parsed: %s" % str(args))
 
-    # Quick and dirty check for PyU4V.conf file existing
-    try:
-        f = open(args.configpath)
-    except IOError:
-        logger.error("Unable to access PyU4V.conf file, check path")
-        sys.exit()
+    global cassette, shard_index, shard_count
+    if args.shard:
+        shard_index, shard_count = args.shard
+        logger.info(f"Collecting shard {shard_index + 1} of {shard_count}")
+
+    if args.replay:
+        # Replays use the anonymized serial, Unisphere isn't needed
+        logger.info(f"Replaying from {args.replay}")
+        cassette = Cassette(args.replay, replaying=True,
+                            speed=args.replay_speed)
+    else:
+        # Quick and dirty check for PyU4V.conf file existing
+        try:
+            f = open(args.configpath)
+        except IOError:
+            logger.error("Unable to access PyU4V.conf file, check path")
+            sys.exit()
+
+        f.close()
 
-    f.close()
+    if args.record:
+        logger.info(f"Recording to {args.record}")
+        cassette = Cassette(args.record)
+        anon = cassette.add_serial(args.array)
+        logger.info(f"Array {args.array} is recorded as {anon}")
 
     result = None
     if args.discovery:
@@ -763,10 +2011,11 @@ def main():
 
         elif args.rdf:
             logger.info("Executing RDF Discovery")
-            result = do_item_discovery(args.configpath, args.array,
-                                       category="RDFS")
-            result += do_item_discovery(args.configpath, args.array,
-                                        category="RDFA")
+            result = itertools.chain(
+                do_item_discovery(args.configpath, args.array,
+                                  category="RDFS"),
+                do_item_discovery(args.configpath, args.array,
+                                  category="RDFA"))
 
         elif args.diskgroup:
             logger.info("Executing Disk Group Discovery")
@@ -800,50 +2049,36 @@ def main():
 
         elif args.emulation:
             logger.info("Executing Emulation Discovery")
-            result = list()
-            for emulation in ['BeEmulation', 'FeEmulation', 'EDSEmulation',
-                              'IMEmulation', 'RDFEmulation']:
-                result += do_item_discovery(args.configpath, args.array,
-                                            category=emulation)
+            result = itertools.chain.from_iterable(
+                do_item_discovery(args.configpath, args.array,
+                                  category=emulation)
+                for emulation in ['BeEmulation', 'FeEmulation',
+                                  'EDSEmulation', 'IMEmulation',
+                                  'RDFEmulation'])
 
         else:
             logger.info("Executing Array Discovery")
             result = do_item_discovery(args.configpath, args.array,
                                        category="Array")
 
-        # Dump our results to STDOUT
-        print(zabbix_safe_output(result))
+        # Stream our results to STDOUT
+        zabbix_safe_output(result)
 
     else:
         if args.array:
             logger.info("Executing Stat collection")
-            if args.hours:
-                logger.info(f"Precollecting {args.hours} worth of statistics")
-
-            result = gather_array_health(args.configpath, args.array)
-
-            # Get data for ALL director types
-            for dir_cat in ['BEDirector', 'FEDirector', 'RDFDirector',
-                            'EDSDirector', 'IMDirector']:
-                result = gather_dir_perf(args.configpath,
-                                         args.array,
-                                         category=dir_cat,
-                                         hours=args.hours)
-
-            # Get data for ALL other objects
-            data_items = ['SRP', 'PortGroup', 'StorageGroup', 'Array',
-                          'Board', 'DiskGroup', 'Host', 'Initiator', 
-                          'RDFS', 'RDFA', 'ISCSITarget']
-
-            """  # Commented out Emulations as we rarely need them
-            data_items = data_items + ['RDFEmulation', 'BeEmulation',
-                                       'FeEmulation', 'EDSEmulation',
-                                       'IMEmulation']
-            """
-
-            for perf_cat in data_items:
-                result = gather_perf(args.configpath, args.array,
-                                     category=perf_cat, hours=args.hours)
+
+            # Don't pile up runs against the same array
+            lock = acquire_lock(args.array)
+            if not lock:
+                sys.exit()
+
+            if not args.serve:
+                collect_stats(args.configpath, args.array, hours=args.hours)
+                lock.close()
+            else:
+                serve_stats(args.configpath, args.array, args.serve,
+                            hours=args.hours)
 
     logger.info("Complete")
 